@@ -1,40 +1,710 @@
 import streamlit as st
+import atexit
 import os
+import json
 import tempfile
 import base64
+import hashlib
+import io
 import re
+import shutil
 import subprocess
+import threading
+import uuid
+from bisect import bisect_left
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import BinaryIO
+from xml.sax.saxutils import escape
 import imageio_ffmpeg as iio_ffmpeg
-from google import genai
-from google.genai.types import HttpOptions, Part
-from google.cloud import storage
-from docx import Document
-from docx.shared import Inches
+
+# The Google SDKs, python-docx and Pillow are imported inside the functions
+# that use them, so the first page render doesn't wait on them.
 
 # --- CONFIGURATION via .streamlit/secrets.toml ---
 cfg = st.secrets["gcp"]
 PROJECT_ID, LOCATION, BUCKET, SA_BASE64 = (
     cfg["project"], cfg["location"], cfg["bucket"], cfg["sa_key"]
 )
+MODEL = "gemini-2.0-flash-001"
+TIMESTAMP_RE = re.compile(r"\[(\d{2}:\d{2}(?::\d{2})?)\]")
+DURATION_RE = re.compile(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)")
+VIDEO_STREAM_RE = re.compile(r"Stream #.*: Video:")
+RUN_SPECIAL_RE = re.compile(r"([\t\r\n])")
+SHOWINFO_PTS_RE = re.compile(r"\[Parsed_showinfo.* n: *\d+ .*pts_time:(\S+)")
+# Vertex's 400 for content below the model's minimum cacheable token count
+CACHE_TOO_SMALL_RE = re.compile(r"minimum token count", re.I)
+# Longer videos don't fit Gemini's context and cost the most, so they're
+# turned away before anything is uploaded
+MAX_VIDEO_SECONDS = 45 * 60
+# Smaller videos go to Gemini inline instead of through GCS. Vertex caps the
+# request at 20 MB and base64 grows the video by a third, so the cutoff is
+# three quarters of the cap less 64 KiB for the prompt and JSON envelope
+INLINE_VIDEO_BYTES = (20_000_000 - 64 * 1024) * 3 // 4
+# Vertex won't cache fewer than 32,768 tokens, and video costs about 263
+# tokens a second, so shorter clips are never offered to caches.create
+MIN_CACHE_SECONDS = 32_768 / 263
+
+
+@st.cache_resource
+def get_tmp_dir() -> str:
+    """One scratch directory per process, reused across reruns and removed at exit."""
+    path = tempfile.mkdtemp(prefix="a1w1_")
+    atexit.register(shutil.rmtree, path, ignore_errors=True)
+    return path
+
+
+tmp_dir = get_tmp_dir()
+
+
+@st.cache_resource
+def get_ffmpeg_exe() -> str:
+    """Locate the bundled ffmpeg binary once per process."""
+    return iio_ffmpeg.get_ffmpeg_exe()
+
+
+FFMPEG_EXE = get_ffmpeg_exe()
+
+
+@st.cache_resource
+def get_clients():
+    """Build the GCP clients once per process instead of on every rerun."""
+    from google import genai
+    from google.auth.transport.requests import Request
+    from google.cloud import storage
+    from google.genai.types import HttpOptions, HttpRetryOptions
+    from google.oauth2 import service_account
+
+    # Credentials come straight from the decoded key; nothing touches disk
+    # and no process-wide env vars are set
+    sa_info = json.loads(base64.b64decode(SA_BASE64))
+    credentials = service_account.Credentials.from_service_account_info(
+        sa_info, scopes=["https://www.googleapis.com/auth/cloud-platform"]
+    )
+    credentials.refresh(Request())
+
+    genai_client = genai.Client(
+        vertexai=True, project=PROJECT_ID, location=LOCATION,
+        credentials=credentials,
+        http_options=HttpOptions(
+            api_version="v1",
+            # Back off on 429s and transient 5xx instead of failing the page
+            retry_options=HttpRetryOptions(attempts=5, initial_delay=1, max_delay=60),
+        ),
+    )
+    gcs_client = storage.Client(project=PROJECT_ID, credentials=credentials)
+    return genai_client, gcs_client, credentials
+
+
+@st.cache_resource
+def get_gemini_slots() -> threading.BoundedSemaphore:
+    """Process-wide cap on concurrent Gemini calls, shared by all sessions."""
+    return threading.BoundedSemaphore(2)
+
+
+# How long a session waits for a free Gemini slot before giving up
+GEMINI_SLOT_TIMEOUT_S = 10 * 60
+
+
+@contextmanager
+def gemini_slot():
+    """Hold one Gemini slot, telling the user while waiting for one."""
+    slots = get_gemini_slots()
+    if not slots.acquire(blocking=False):
+        notice = st.info("Waiting for a free Gemini slot; other drafts are running…")
+        acquired = slots.acquire(timeout=GEMINI_SLOT_TIMEOUT_S)
+        notice.empty()
+        if not acquired:
+            raise RuntimeError(
+                "Gemini stayed busy with other drafts; try again in a few minutes"
+            )
+    try:
+        yield
+    finally:
+        slots.release()
+
+
+def video_part(gcs_uri: str | None, video_bytes: bytes):
+    """The video as a Gemini Part: by gs:// URI if uploaded, else inline."""
+    from google.genai.types import Part
+
+    if gcs_uri is None:
+        return Part.from_bytes(data=video_bytes, mime_type="video/mp4")
+    return Part.from_uri(file_uri=gcs_uri, mime_type="video/mp4")
+
+
+@st.cache_data(ttl=55 * 60, show_spinner=False)
+def get_video_cache(video_sha256: str, gcs_uri: str | None,
+                    _video_bytes: bytes) -> str | None:
+    """Cache a video's tokens in Vertex for an hour; returns the cache name.
+
+    Prompt tweaks on the same video then bill the video at the cached-token
+    rate instead of re-processing it, and inline videos aren't re-sent.
+    Kept a few minutes short of the server-side TTL so a cache is never
+    referenced after it expires. Videos below the model's minimum cacheable
+    size come back as None.
+    """
+    from google.genai.errors import ClientError
+    from google.genai.types import Content, CreateCachedContentConfig
+
+    client, _, _ = get_clients()
+    try:
+        cache = client.caches.create(
+            model=MODEL,
+            config=CreateCachedContentConfig(
+                contents=[Content(role="user", parts=[
+                    video_part(gcs_uri, _video_bytes)
+                ])],
+                display_name=video_sha256,
+                ttl="3600s",
+            ),
+        )
+    except ClientError as e:
+        # Only "too small to cache" is worth remembering for the hour; quota,
+        # permission and other errors propagate and aren't cached
+        if e.code == 400 and CACHE_TOO_SMALL_RE.search(e.message or ""):
+            return None
+        raise
+    return cache.name
+
+
+@st.cache_data(persist="disk", show_spinner=False)
+def saved_draft(video_sha256: str, prompt: str, model: str,
+                _text: str | None = None) -> str:
+    """Disk-persisted draft text per (video, prompt, model).
+
+    Called without `_text` it only looks up: a miss raises LookupError, and
+    exceptions are never cached. Called with `_text` it stores that text.
+    Only the string is cached, so a hit carries no recorded elements to
+    replay.
+    """
+    if _text is None:
+        raise LookupError(video_sha256)
+    return _text
+
+
+@st.cache_resource
+def get_drafted_videos() -> set[str]:
+    """Process-wide set of video digests that already have a draft."""
+    return set()
+
+
+def summarize(video_sha256: str, gcs_uri: str | None, prompt: str,
+              video_bytes: bytes, duration: float | None) -> str:
+    """Stream work instructions for a video; cached per (video, prompt).
+
+    Tokens render as they arrive; a draft already on disk is rendered once
+    instead of calling Gemini again, so a browser refresh or a server
+    restart doesn't pay for the call twice. Without a gs:// URI the video
+    is sent inline.
+    """
+    from google.genai.types import FinishReason, GenerateContentConfig
+
+    drafted_videos = get_drafted_videos()
+    try:
+        text = saved_draft(video_sha256, prompt, MODEL)
+    except LookupError:
+        pass
+    else:
+        drafted_videos.add(video_sha256)
+        st.markdown(text)
+        return text
+
+    # A context cache bills the video's tokens once more plus an hour of
+    # storage, which only pays off from a video's second prompt. Clips too
+    # short (or of unknown length) to reach the minimum are never sent.
+    use_cache = (
+        video_sha256 in drafted_videos
+        and duration is not None and duration >= MIN_CACHE_SECONDS
+    )
+
+    client, _, _ = get_clients()
+    finish_reasons = []
+
+    def texts(stream):
+        for chunk in stream:
+            if chunk.candidates and chunk.candidates[0].finish_reason:
+                finish_reasons.append(chunk.candidates[0].finish_reason)
+            yield chunk.text or ""
+
+    # Creating the context cache sends the whole video too, so it counts
+    # against the same slot as the draft
+    with gemini_slot():
+        if use_cache and (
+            cache_name := get_video_cache(video_sha256, gcs_uri, video_bytes)
+        ):
+            contents = [prompt]
+            config = GenerateContentConfig(cached_content=cache_name)
+        else:
+            contents, config = [video_part(gcs_uri, video_bytes), prompt], None
+        stream = client.models.generate_content_stream(
+            model=MODEL, contents=contents, config=config
+        )
+        text = st.write_stream(texts(stream))
+    # The draft is persisted with no expiry, so a blocked, empty or cut-off
+    # response must raise rather than be stored
+    if not text:
+        raise RuntimeError("Gemini returned no text")
+    if finish_reasons and finish_reasons[-1] != FinishReason.STOP:
+        raise RuntimeError(f"Gemini stopped early ({finish_reasons[-1].name})")
+    drafted_videos.add(video_sha256)
+    return saved_draft(video_sha256, prompt, MODEL, _text=text)
+
+
+def save_local(video_sha256: str, video: BinaryIO) -> str:
+    """Write the upload to the scratch dir for ffmpeg; returns its path.
+
+    Written under a temporary name and renamed, so a concurrent rerun never
+    sees a half-written file.
+    """
+    local_path = os.path.join(tmp_dir, f"{video_sha256}.mp4")
+    if not os.path.exists(local_path):
+        video.seek(0)
+        partial = f"{local_path}.{uuid.uuid4().hex}.part"
+        with open(partial, "wb") as f:
+            shutil.copyfileobj(video, f, length=8 * 1024 * 1024)
+        os.replace(partial, local_path)
+    return local_path
+
+
+class ProgressReader:
+    """File wrapper that reports the fraction read after each read()."""
+
+    def __init__(self, f: BinaryIO, size: int, on_progress):
+        self._f, self._size, self._on_progress = f, size, on_progress
+
+    def read(self, n: int = -1) -> bytes:
+        data = self._f.read(n)
+        self._on_progress(min(self._f.tell() / self._size, 1.0))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+
+# Above this size, upload from the local copy in parallel parts instead of
+# one resumable stream; only the resumable stream reports progress
+PARALLEL_UPLOAD_BYTES = 64 * 1024 * 1024
+
+
+@st.cache_resource
+def get_uploaded_uris() -> dict[tuple[str, str], str]:
+    """Process-wide record of finished uploads, keyed by (sha256, file name)."""
+    return {}
+
+
+def upload_video(video_sha256: str, name: str, video_file: BinaryIO,
+                 local_path: str) -> str:
+    """Upload a video to GCS once per distinct content; returns its gs:// URI.
+
+    Keyed on the sha256 rather than the file itself, so reruns skip the
+    upload without rehashing the whole video. The record is kept outside
+    st.cache_data, which would replay the progress elements on every rerun.
+    """
+    from google.api_core.exceptions import NotFound
+    from google.cloud.storage import transfer_manager
+
+    uploaded_uris = get_uploaded_uris()
+    if uri := uploaded_uris.get((video_sha256, name)):
+        return uri
+    _, storage_client, _ = get_clients()
+
+    # Content-addressed object path: identical bytes are already there, so
+    # only the first upload of a video pays for it. The stored sha256 (or, for
+    # objects from before it was recorded, the MD5) guards against a partial
+    # or foreign object at that path; either costs one metadata GET.
+    gcs_path = f"input/{video_sha256}/{name}"
+    blob = storage_client.bucket(BUCKET).blob(gcs_path, chunk_size=8 * 1024 * 1024)
+    try:
+        blob.reload()
+        uploaded = (blob.metadata or {}).get("sha256") == video_sha256 or (
+            blob.md5_hash == base64.b64encode(
+                hashlib.md5(video_file.getvalue()).digest()
+            ).decode()
+        )
+    except NotFound:
+        uploaded = False
+    if not uploaded:
+        # Parallel (XML multipart) uploads carry no whole-object MD5, so the
+        # sha256 is recorded for the check above
+        blob.metadata = {"sha256": video_sha256}
+        if video_file.size > PARALLEL_UPLOAD_BYTES:
+            # transfer_manager reports nothing until every part is done, so
+            # large uploads get a note instead of a progress bar
+            note = st.caption(
+                "Uploading in parallel parts; no progress is shown for large videos."
+            )
+            transfer_manager.upload_chunks_concurrently(
+                local_path, blob, content_type="video/mp4",
+                worker_type=transfer_manager.THREAD, max_workers=8, timeout=600,
+            )
+            note.empty()
+        else:
+            # With the size known, files up to 8 MiB go up in one multipart
+            # request; larger ones as a resumable upload in chunk_size pieces,
+            # so a failure retries a piece rather than the whole file
+            bar = st.progress(0.0, text="Uploading…")
+            video_file.seek(0)
+            blob.upload_from_file(
+                ProgressReader(video_file, video_file.size, bar.progress),
+                size=video_file.size, content_type="video/mp4", checksum="md5",
+                timeout=600,
+            )
+            bar.empty()
+    uri = uploaded_uris[video_sha256, name] = f"gs://{BUCKET}/{gcs_path}"
+    return uri
+
+
+def ts_to_sec(t: str) -> int:
+    """Convert an `MM:SS` or `HH:MM:SS` timestamp to whole seconds."""
+    seconds = 0
+    for part in t.split(":"):
+        seconds = seconds * 60 + int(part)
+    return seconds
+
+
+@st.cache_data(show_spinner=False)
+def probe_video(video_sha256: str, _video_path: str) -> tuple[bool, float | None]:
+    """Check for a video stream and read the duration from ffmpeg's header dump.
 
-# Write service account JSON to temp file
-tmp_dir = tempfile.mkdtemp()
-sa_path = os.path.join(tmp_dir, "sa.json")
-with open(sa_path, "wb") as f:
-    f.write(base64.b64decode(SA_BASE64))
+    Returns (has_video, seconds); seconds is None when the container doesn't
+    record a duration, as with fragmented MP4 from many screen recorders.
+    Without an output file ffmpeg exits right after printing the input's
+    header, so nothing is decoded.
+    """
+    log = subprocess.run(
+        [FFMPEG_EXE, "-hide_banner", "-i", _video_path],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        text=True, errors="replace"
+    ).stderr
+    if not VIDEO_STREAM_RE.search(log):
+        return False, None
+    if not (m := DURATION_RE.search(log)):
+        return True, None
+    hours, minutes, seconds = m.groups()
+    return True, int(hours) * 3600 + int(minutes) * 60 + float(seconds)
 
-# Set Google Cloud env
-os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = sa_path
-os.environ["GOOGLE_CLOUD_PROJECT"]       = PROJECT_ID
-os.environ["GOOGLE_CLOUD_LOCATION"]      = LOCATION
-os.environ["GOOGLE_GENAI_USE_VERTEXAI"]  = "True"
 
-# Initialize clients
-client = genai.Client(http_options=HttpOptions(api_version="v1"))
-storage_client = storage.Client()
+def index_timestamps(summary: str) -> dict[str, str]:
+    """Map each timestamp to the first summary line that mentions it."""
+    snippets = {}
+    for line in summary.splitlines():
+        for t in TIMESTAMP_RE.findall(line):
+            snippets.setdefault(t, line.strip())
+    return snippets
+
+
+def decode_frames(video_path: str, input_params: list[str],
+                  output_params: list[str],
+                  log: list[str] | None = None) -> list[bytes]:
+    """Pipe frames out of ffmpeg as JPEG bytes, without touching disk.
+
+    ffmpeg's MJPEG encoder byte-stuffs 0xFF inside entropy-coded data, so the
+    EOI marker only ever appears at the end of a frame. Frames are split off
+    as the pipe is read rather than after ffmpeg exits, so only the frame in
+    flight is ever buffered twice. If `log` is given, ffmpeg's stderr lines
+    are appended to it, drained on a thread so neither pipe can fill up.
+    """
+    frames, buf = [], bytearray()
+    with subprocess.Popen(
+        [FFMPEG_EXE, *input_params, "-i", video_path, *output_params,
+         "-an", "-sn", "-dn", "-f", "image2pipe", "-vcodec", "mjpeg", "-q:v", "3", "-"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL if log is None else subprocess.PIPE,
+        bufsize=1024 * 1024
+    ) as proc:
+        if log is not None:
+            drain = threading.Thread(
+                target=lambda: log.extend(
+                    line.decode(errors="replace") for line in proc.stderr
+                ),
+                daemon=True,
+            )
+            drain.start()
+        while chunk := proc.stdout.read(1024 * 1024):
+            # The marker may straddle the previous read, so back up one byte
+            start = max(len(buf) - 1, 0)
+            buf += chunk
+            while (end := buf.find(b"\xff\xd9", start)) != -1:
+                frames.append(bytes(buf[:end + 2]))
+                del buf[:end + 2]
+                start = 0
+        if log is not None:
+            drain.join()
+    return frames
+
+
+# How far past a timestamp the keyframe used for its still may be
+KEYFRAME_TOLERANCE_S = 2
+# Timestamps this close to the previous one reuse its still
+FRAME_DEDUP_S = 1
+# Stills are never shown wider than 3 in at 300 DPI, so ffmpeg scales them
+# down before encoding; smaller videos keep their own width
+SCALE_FILTER = "scale='min(900,iw)':-2"
+
+
+def extract_frame(video_path: str, seconds: int) -> bytes | None:
+    """Grab the frame at a single offset, if the video is that long."""
+    frames = decode_frames(
+        video_path, ["-ss", str(seconds)], ["-vf", SCALE_FILTER, "-frames:v", "1"]
+    )
+    return frames[0] if frames else None
+
+
+@st.cache_data(max_entries=16, persist="disk", show_spinner=False)
+def extract_frames(video_sha256: str, times: list[str],
+                   _video_path: str) -> dict[str, bytes]:
+    """Grab one frame per timestamp in a single keyframe-only ffmpeg pass.
+
+    Cached per (video, timestamps) so reruns never re-spawn ffmpeg; the path
+    is left out of the key since the hash already identifies the video.
+    Stills don't need the exact frame, so the decoder skips everything but
+    keyframes and each timestamp takes the first keyframe within
+    KEYFRAME_TOLERANCE_S after it. showinfo reports each selected frame's
+    pts_time, which is how frames are matched back to timestamps; only
+    timestamps left without one are seeked to individually. `times` must
+    be sorted.
+    """
+    if not times:
+        return {}
+    # Timestamps within FRAME_DEDUP_S of the previous kept one share its frame
+    canonical, kept, seconds = {}, [], []
+    for t, s in zip(times, map(ts_to_sec, times)):
+        if seconds and s - seconds[-1] <= FRAME_DEDUP_S:
+            canonical[t] = kept[-1]
+        else:
+            canonical[t] = t
+            kept.append(t)
+            seconds.append(s)
+
+    select_expr = "+".join(
+        f"between(t,{s},{s + KEYFRAME_TOLERANCE_S})*not(gte(prev_t,{s}))"
+        for s in seconds
+    )
+    log = []
+    decoded = decode_frames(
+        _video_path, ["-skip_frame", "nokey"],
+        ["-vf", f"select='{select_expr}',showinfo,{SCALE_FILTER}",
+         "-fps_mode", "passthrough", "-frames:v", str(len(kept))],
+        log=log,
+    )
+    pts = [float(m.group(1)) for line in log if (m := SHOWINFO_PTS_RE.search(line))]
+    frames = {}
+    if len(pts) == len(decoded):
+        # The first keyframe at or after a timestamp is selected whenever it's
+        # within tolerance, so a later selected frame means there was none
+        for t, s in zip(kept, seconds):
+            i = bisect_left(pts, s)
+            if i < len(pts) and pts[i] - s <= KEYFRAME_TOLERANCE_S:
+                frames[t] = decoded[i]
+    missing = [(t, s) for t, s in zip(kept, seconds) if t not in frames]
+    if missing:
+        # No keyframe close enough, or a timestamp past the end: seek to each
+        # one independently, in parallel; past the end simply yields no frame.
+        # Concurrent ffmpeg decodes stop scaling past about eight.
+        workers = min(len(missing), os.cpu_count() or 1, 8)
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            results = ex.map(lambda ts: extract_frame(_video_path, ts[1]), missing)
+        frames.update(
+            (t, f) for (t, _), f in zip(missing, results) if f is not None
+        )
+    return {t: frames[c] for t, c in canonical.items() if c in frames}
+
+
+def encode_thumbnail(frame: bytes, width_px: int = 384) -> bytes:
+    """Downscale a JPEG frame for embedding in the DOCX."""
+    from PIL import Image
+
+    img = Image.open(io.BytesIO(frame))
+    img.thumbnail((width_px, width_px))
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=85)
+    return buf.getvalue()
+
+
+def run_xml(text: str) -> str:
+    """WordprocessingML for one run of text, as `add_paragraph` would build it.
+
+    Tabs become <w:tab/> and each CR or LF a <w:br/>; empty text gets no run.
+    """
+    if not text:
+        return ""
+    parts = []
+    for piece in RUN_SPECIAL_RE.split(text):
+        if piece == "\t":
+            parts.append("<w:tab/>")
+        elif piece in ("\r", "\n"):
+            parts.append("<w:br/>")
+        elif piece:
+            space = ' xml:space="preserve"' if piece != piece.strip() else ""
+            parts.append(f"<w:t{space}>{escape(piece)}</w:t>")
+    return f"<w:r>{''.join(parts)}</w:r>"
+
+
+@st.cache_data(show_spinner=False)
+def build_docx(summary: str, video_sha256: str,
+               _frames: dict[str, bytes]) -> bytes:
+    """Render the summary and its key frames as .docx bytes, built in memory.
+
+    Cached per (summary, video); the frames follow from those two, so they are
+    left out of the key. Paragraphs are emitted as one XML fragment and
+    spliced into the body in a single lxml operation rather than one
+    `add_paragraph` call per line.
+    """
+    from docx import Document
+    from docx.oxml import parse_xml
+    from docx.oxml.ns import nsdecls
+    from docx.shared import Inches
+
+    doc = Document()
+    doc.add_heading("Work Instructions", 0)
+    heading = doc.styles["Heading 2"].style_id
+    xml = []
+    for block in summary.strip().split("\n\n"):
+        lines = block.split("\n")
+        xml.append(
+            f'<w:p><w:pPr><w:pStyle w:val="{heading}"/></w:pPr>'
+            f'{run_xml(lines[0])}</w:p>'
+        )
+        xml.extend(f"<w:p>{run_xml(line)}</w:p>" for line in lines[1:])
+    fragment = parse_xml(f"<w:body {nsdecls('w')}>{''.join(xml)}</w:body>")
+    body = doc.element.body
+    at = body.index(body.sectPr)
+    body[at:at] = list(fragment)
+
+    if _frames:
+        # Thumbnail encoding is the slow part; Pillow releases the GIL while
+        # encoding, so the frames are processed in parallel.
+        with ThreadPoolExecutor() as ex:
+            images = list(ex.map(encode_thumbnail, _frames.values()))
+        doc.add_heading("Key Frames", 1)
+        for t, image in zip(_frames, images):
+            doc.add_paragraph(f"Frame at {t}")
+            doc.add_picture(io.BytesIO(image), width=Inches(2.0))
+
+    buf = io.BytesIO()
+    doc.save(buf)
+    return buf.getvalue()
+
+
+# --- Batch mode ---
+BATCH_DONE_STATES = {
+    "JOB_STATE_SUCCEEDED", "JOB_STATE_PARTIALLY_SUCCEEDED",
+    "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED",
+}
+
+
+def queue_for_batch(video_sha256: str, name: str, gcs_uri: str, prompt: str):
+    """Add a (video, prompt) pair to this session's pending batch."""
+    queue = st.session_state.setdefault("batch_queue", {})
+    queue[(video_sha256, prompt)] = {"name": name, "gcs_uri": gcs_uri, "prompt": prompt}
+
+
+def submit_batch():
+    """Write the queued requests to GCS as JSONL and start a batch prediction job."""
+    from google.genai.types import CreateBatchJobConfig
+
+    queue = st.session_state.pop("batch_queue", {})
+    lines = [
+        json.dumps({"request": {"contents": [{"role": "user", "parts": [
+            {"fileData": {"fileUri": item["gcs_uri"], "mimeType": "video/mp4"}},
+            {"text": item["prompt"]},
+        ]}]}})
+        for item in queue.values()
+    ]
+    # Results come back keyed by (video URI, prompt); label them by file name
+    # and, when a video was queued with several prompts, which one it was
+    per_video = Counter(item["gcs_uri"] for item in queue.values())
+    labels, seen = {}, Counter()
+    for item in queue.values():
+        label = item["name"]
+        if per_video[item["gcs_uri"]] > 1:
+            seen[item["gcs_uri"]] += 1
+            label += f" · prompt {seen[item['gcs_uri']]}"
+        labels[item["gcs_uri"], item["prompt"]] = label
+    prefix = f"batch/{uuid.uuid4().hex}"
+    try:
+        client, storage_client, _ = get_clients()
+        storage_client.bucket(BUCKET).blob(f"{prefix}/input.jsonl").upload_from_string(
+            "\n".join(lines), content_type="application/jsonl"
+        )
+        job = client.batches.create(
+            model=MODEL,
+            src=f"gs://{BUCKET}/{prefix}/input.jsonl",
+            config=CreateBatchJobConfig(dest=f"gs://{BUCKET}/{prefix}/output"),
+        )
+    except Exception as e:
+        st.session_state.batch_queue = queue
+        st.error(f"Batch submission failed: {e}")
+        return
+    st.session_state.batch_job = job.name
+    st.session_state.batch_labels = labels
+    st.session_state.pop("batch_results", None)
+    st.session_state.pop("batch_outcome", None)
+
+
+def read_batch_results(dest_uri: str) -> dict[tuple[str, str], str]:
+    """Map each (video URI, prompt) to the generated text in a finished job's output."""
+    _, storage_client, _ = get_clients()
+    prefix = dest_uri.removeprefix(f"gs://{BUCKET}/")
+    results = {}
+    for out_blob in storage_client.list_blobs(BUCKET, prefix=prefix):
+        if not out_blob.name.endswith("predictions.jsonl"):
+            continue
+        for line in out_blob.download_as_text().splitlines():
+            row = json.loads(line)
+            video, text = row["request"]["contents"][0]["parts"]
+            candidates = row.get("response", {}).get("candidates", [])
+            parts = candidates[0]["content"]["parts"] if candidates else []
+            results[video["fileData"]["fileUri"], text["text"]] = (
+                "".join(p.get("text", "") for p in parts) or row.get("status", "")
+            )
+    return results
+
+
+@st.fragment(run_every=30)
+def batch_status():
+    """Poll the submitted job; a full rerun shows results once it finishes."""
+    client, _, _ = get_clients()
+    try:
+        job = client.batches.get(name=st.session_state.batch_job)
+    except Exception as e:
+        # Transient; the next poll tries again
+        st.caption(f"Batch job: status unavailable ({e})")
+        return
+    st.caption(f"Batch job: {job.state.name if job.state else 'pending'}")
+    if job.state in BATCH_DONE_STATES:
+        st.session_state.batch_results = (
+            read_batch_results(job.dest.gcs_uri) if job.dest and job.dest.gcs_uri else {}
+        )
+        st.session_state.batch_outcome = {
+            "state": job.state.name, "error": job.error.message if job.error else None
+        }
+        st.session_state.pop("batch_job")
+        st.rerun()
+
+
+def render_batch_panel():
+    """Sidebar listing the queued videos, the running job and finished results."""
+    st.header("🗂️ Batch queue")
+    queue = st.session_state.get("batch_queue", {})
+    for item in queue.values():
+        st.write(f"• {item['name']}")
+    st.button(
+        f"Submit batch ({len(queue)})", on_click=submit_batch, disabled=not queue
+    )
+    if "batch_job" in st.session_state:
+        batch_status()
+    outcome = st.session_state.get("batch_outcome")
+    if outcome and outcome["state"] != "JOB_STATE_SUCCEEDED":
+        st.error(f"Batch job ended as {outcome['state']}"
+                 + (f": {outcome['error']}" if outcome["error"] else ""))
+    labels = st.session_state.get("batch_labels", {})
+    for key, text in st.session_state.get("batch_results", {}).items():
+        with st.expander(labels.get(key, key[0].rsplit("/", 1)[-1])):
+            st.code(text, language="markdown")
 
-# Locate the bundled ffmpeg binary
-FFMPEG_EXE = iio_ffmpeg.get_ffmpeg_exe()
 
 # --- UI Setup ---
 st.set_page_config(page_title="📦 Video-to-WI Generator")
@@ -83,66 +753,92 @@ def_prompt = (
     "Keep formatting clean and consistent. Ensure each action step is precisely tied to its visual frame."
 )
 
-prompt = st.text_area("Prompt", value=def_prompt, height=250)
+batch_mode = st.toggle("Batch mode (about half the cost; results arrive asynchronously)")
+
+# Prompt edits and uploads take effect together on submit, so typing in the
+# prompt doesn't rerun the page or start a Gemini call
+with st.form("wi_form"):
+    prompt = st.text_area("Prompt", value=def_prompt, height=250)
+    video_file = st.file_uploader("Upload .mp4 video", type=["mp4"])
+    st.form_submit_button("Generate Draft WI", type="primary")
+
+with st.sidebar:
+    render_batch_panel()
 
-if video_file := st.file_uploader("Upload .mp4 video", type=["mp4"]):
+if video_file:
     st.video(video_file)
 
-    # Save locally
-    local_path = os.path.join(tmp_dir, video_file.name)
-    with open(local_path, "wb") as f:
-        f.write(video_file.read())
+    # Hash each upload once; every cache below is keyed on this digest.
+    # getvalue() shares the upload's buffer, whereas getbuffer() would copy it.
+    if st.session_state.get("video_file_id") != video_file.file_id:
+        st.session_state.video_file_id = video_file.file_id
+        st.session_state.video_sha256 = hashlib.sha256(video_file.getvalue()).hexdigest()
+    video_sha256 = st.session_state.video_sha256
 
-    # Upload to GCS
-    gcs_path = f"input/{video_file.name}"
-    bucket = storage_client.bucket(BUCKET)
-    blob = bucket.blob(gcs_path)
-    try:
-        blob.upload_from_filename(local_path)
-        st.success(f"Uploaded to gs://{BUCKET}/{gcs_path}")
-    except Exception as e:
-        st.error(f"Failed to upload video: {e}")
+    # ffmpeg reads the video from disk, starting with the duration check below
+    local_path = save_local(video_sha256, video_file)
+
+    # Reject unreadable or overlong videos before paying for GCS or Gemini
+    has_video, duration = probe_video(video_sha256, local_path)
+    if not has_video:
+        st.error("Couldn't read this file as a video.")
+        st.stop()
+    if duration is not None and duration > MAX_VIDEO_SECONDS:
+        st.error(
+            f"This video runs {duration / 60:.0f} min; "
+            f"the limit is {MAX_VIDEO_SECONDS // 60} min."
+        )
+        st.stop()
+
+    # Batch jobs read their inputs from GCS, so only interactive runs of
+    # small videos skip the upload
+    gcs_uri = None
+    if batch_mode or video_file.size > INLINE_VIDEO_BYTES:
+        with st.status("Uploading video…") as upload_status:
+            try:
+                gcs_uri = upload_video(
+                    video_sha256, video_file.name, video_file, local_path
+                )
+            except Exception as e:
+                upload_status.update(label="Upload failed", state="error")
+                st.error(f"Failed to upload video: {e}")
+                st.stop()
+            upload_status.update(label=f"Uploaded to {gcs_uri}", state="complete")
+
+    if batch_mode:
+        st.button(
+            "➕ Add to batch queue", on_click=queue_for_batch,
+            args=(video_sha256, video_file.name, gcs_uri, prompt),
+        )
         st.stop()
 
     # Generate with Vertex AI
     st.markdown("### ✏️ Generating Work Instructions…")
     try:
-        resp = client.models.generate_content(
-            model="gemini-2.0-flash-001",
-            contents=[
-                Part.from_uri(file_uri=f"gs://{BUCKET}/{gcs_path}", mime_type="video/mp4"),
-                prompt
-            ],
-        )
-        summary = resp.text
         st.markdown("#### Draft Instructions")
-        st.code(summary, language="markdown")
+        summary = summarize(
+            video_sha256, gcs_uri, prompt, video_file.getvalue(), duration
+        )
     except Exception as e:
         st.error(f"Vertex AI request failed: {e}")
         st.stop()
 
     # Preview key frames based on those timestamps
-    st.markdown("### 🖼️ Key Frame Previews")
-    times = re.findall(r"\[(\d{2}:\d{2})\]", summary)
-    for t in sorted(set(times)):
-        img_path = os.path.join(tmp_dir, f"frame_{t.replace(':','_')}.png")
-        subprocess.run(
-            [FFMPEG_EXE, "-y", "-ss", t, "-i", local_path, "-vframes", "1", img_path],
-            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
-        )
-        if os.path.exists(img_path):
-            st.image(img_path, caption=f"Frame at {t}")
+    snippets = index_timestamps(summary)
+    frames = {}
+    if not snippets:
+        st.info("No timestamps detected in draft")
+    else:
+        st.markdown("### 🖼️ Key Frame Previews")
+        times = sorted(snippets, key=ts_to_sec)
+        frames = extract_frames(video_sha256, times, local_path)
+        for t, frame in frames.items():
+            st.image(frame, caption=snippets[t])
 
     # Export to DOCX
     st.markdown("### 📄 Download as DOCX")
-    doc = Document()
-    doc.add_heading("Work Instructions", 0)
-    for block in summary.strip().split("\n\n"):
-        lines = block.split("\n")
-        doc.add_paragraph(lines[0], style="Heading 2")
-        for line in lines[1:]:
-            doc.add_paragraph(line)
-    docx_path = os.path.join(tmp_dir, "work_instruction.docx")
-    doc.save(docx_path)
-    with open(docx_path, "rb") as f:
-        st.download_button("Download WI .docx", f, file_name="work_instruction.docx")
+    st.download_button(
+        "Download WI .docx", build_docx(summary, video_sha256, frames),
+        file_name="work_instruction.docx",
+        mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    )